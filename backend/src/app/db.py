@@ -1,190 +1,186 @@
 """
 Patient 360 Backend - Database Module
 
-Provides PostgreSQL connection pool using pg8000 (pure Python).
-Uses asyncio.to_thread for async compatibility with FastAPI.
+Provides PostgreSQL connection pool using asyncpg.
+Queries are natively awaitable and use $1, $2 style parameters directly.
 """
 
-import logging
 import asyncio
-import re
+import logging
 from contextlib import asynccontextmanager
-from typing import AsyncGenerator, Optional
-from urllib.parse import urlparse, parse_qs, unquote
+from typing import AsyncGenerator, Optional, TypeVar
 
-import pg8000.native
+import asyncpg
+import orjson
+from pydantic import BaseModel
 
 from app.settings import get_settings
 
 logger = logging.getLogger(__name__)
 
-# Connection pool (simple list-based pool)
-_pool: list[pg8000.native.Connection] = []
-_pool_size: int = 5
+# Connection pool (created in init_db_pool, or on first use if that failed)
+_pool: Optional[asyncpg.Pool] = None
 _pool_lock = asyncio.Lock()
 
+ModelT = TypeVar("ModelT", bound=BaseModel)
 
-def _convert_params(query: str, args: tuple) -> tuple[str, dict]:
-    """
-    Convert $1, $2 style parameters to pg8000's :p1, :p2 style.
-    Returns (converted_query, params_dict).
-    """
-    if not args:
-        return query, {}
-    
-    # Convert $1, $2, ... to :p1, :p2, ...
-    converted_query = re.sub(r'\$(\d+)', r':p\1', query)
-    
-    # Build kwargs dict: {'p1': args[0], 'p2': args[1], ...}
-    params_dict = {f'p{i+1}': arg for i, arg in enumerate(args)}
-    
-    return converted_query, params_dict
 
+def _json_encode(value) -> str:
+    """Encode a Python object as JSON text for a json/jsonb parameter."""
+    return orjson.dumps(value).decode()
 
-def _parse_database_url(url: str) -> dict:
-    """Parse database URL into connection parameters."""
-    parsed = urlparse(url)
-    
-    # URL decode username and password
-    password = unquote(parsed.password) if parsed.password else ""
-    username = unquote(parsed.username) if parsed.username else "postgres"
-    
-    params = {
-        "host": parsed.hostname or "localhost",
-        "port": parsed.port or 5432,
-        "database": parsed.path.lstrip("/") if parsed.path else "postgres",
-        "user": username,
-        "password": password,
-    }
-    
-    logger.info(f"Connecting to {params['host']}:{params['port']}/{params['database']} as {params['user']}")
-    
-    # Parse query parameters for SSL
-    query_params = parse_qs(parsed.query)
-    if "sslmode" in query_params:
-        sslmode = query_params["sslmode"][0]
-        if sslmode in ("require", "verify-ca", "verify-full"):
-            params["ssl_context"] = True
-    
-    return params
 
+async def _init_connection(conn: asyncpg.Connection) -> None:
+    """Configure a newly opened connection."""
+    # Decode json/jsonb columns to Python objects (and encode them on the way in)
+    for type_name in ("json", "jsonb"):
+        await conn.set_type_codec(
+            type_name,
+            encoder=_json_encode,
+            decoder=orjson.loads,
+            schema="pg_catalog"
+        )
 
-def _create_connection() -> pg8000.native.Connection:
-    """Create a new database connection."""
+
+async def _create_pool() -> asyncpg.Pool:
+    """Create the connection pool and verify it can reach the database."""
     settings = get_settings()
-    conn_params = _parse_database_url(settings.database_url)
-    return pg8000.native.Connection(**conn_params)
+
+    # With prewarming, every connection is opened up front so no request
+    # pays for a connection handshake
+    min_size = settings.db_pool_max_size if settings.db_pool_prewarm else settings.db_pool_min_size
+
+    pool = await asyncpg.create_pool(
+        dsn=settings.database_url,
+        min_size=min_size,
+        max_size=settings.db_pool_max_size,
+        statement_cache_size=settings.db_statement_cache_size,
+        # Bounded connect timeout: requests queue behind a lazy pool creation
+        # attempt (see _get_pool), so it must fail fast when the DB is down
+        timeout=settings.db_connect_timeout,
+        command_timeout=settings.db_command_timeout,
+        init=_init_connection
+    )
+
+    # Test connection (don't leak the pool if the database rejects queries)
+    try:
+        await pool.fetchval("SELECT 1")
+    except Exception:
+        await pool.close()
+        raise
+    logger.info("Database connection successful")
+
+    # Note keyword search falls back to sequential scans without the trigram index
+    if await pool.fetchval("SELECT to_regclass('idx_notes_phi_text_trgm')") is None:
+        logger.warning(
+            "Index idx_notes_phi_text_trgm not found - note keyword search will scan "
+            "every note (run db/migrations/070_performance_indexes.sql)"
+        )
+
+    return pool
+
+
+async def _get_pool() -> asyncpg.Pool:
+    """
+    Return the connection pool, creating it if it does not exist yet.
+    
+    If the database was unreachable at startup (or pool creation failed
+    later), each request retries pool creation, so the API recovers once
+    the database is back instead of failing until restart.
+    """
+    global _pool
+
+    if _pool is None:
+        async with _pool_lock:
+            if _pool is None:
+                _pool = await _create_pool()
+
+    return _pool
 
 
 async def init_db_pool():
     """Initialize the database connection pool."""
-    global _pool, _pool_size
-    
-    settings = get_settings()
-    _pool_size = settings.db_pool_max_size
-    
     logger.info("Initializing database connection pool...")
-    
-    # Create initial connections
-    for i in range(settings.db_pool_min_size):
-        try:
-            conn = await asyncio.to_thread(_create_connection)
-            _pool.append(conn)
-        except Exception as e:
-            logger.error(f"Failed to create initial connection: {e}")
-            if i == 0:
-                # If first connection fails, warn but continue (for development)
-                logger.warning("Continuing without database connection - API will be degraded")
-                return _pool
-            raise
-    
-    # Test connection
-    if _pool:
-        result = await asyncio.to_thread(_pool[0].run, "SELECT 1")
-        logger.info("Database connection successful")
-    
+
+    try:
+        await _get_pool()
+    except Exception as e:
+        # If the database is unreachable, warn but continue (for development);
+        # the pool is created on first use once the database is reachable
+        logger.error(f"Failed to create connection pool: {e}")
+        logger.warning("Continuing without database connection - API will be degraded")
+
     return _pool
 
 
 async def close_db_pool():
     """Close all connections in the pool."""
     global _pool
-    
+
     logger.info("Closing database connection pool...")
-    
-    for conn in _pool:
+
+    if _pool is not None:
         try:
-            await asyncio.to_thread(conn.close)
+            await _pool.close()
         except Exception:
             pass
-    
-    _pool = []
+
+    _pool = None
 
 
 @asynccontextmanager
-async def get_connection() -> AsyncGenerator[pg8000.native.Connection, None]:
+async def get_connection() -> AsyncGenerator[asyncpg.Connection, None]:
     """Get a database connection from the pool."""
-    global _pool
-    
-    conn = None
-    async with _pool_lock:
-        if _pool:
-            conn = _pool.pop()
-        elif len(_pool) < _pool_size:
-            conn = await asyncio.to_thread(_create_connection)
-    
-    if conn is None:
-        # Wait and retry
-        await asyncio.sleep(0.1)
-        async with _pool_lock:
-            if _pool:
-                conn = _pool.pop()
-            else:
-                conn = await asyncio.to_thread(_create_connection)
-    
-    try:
+    pool = await _get_pool()
+
+    async with pool.acquire() as conn:
         yield conn
-    finally:
-        async with _pool_lock:
-            if len(_pool) < _pool_size:
-                _pool.append(conn)
-            else:
-                await asyncio.to_thread(conn.close)
 
 
 async def execute_query(query: str, *args) -> list[dict]:
     """Execute a query and return results as list of dicts."""
     async with get_connection() as conn:
-        # Convert $1, $2 to :p1, :p2 style for pg8000
-        converted_query, params = _convert_params(query, args)
-        rows = await asyncio.to_thread(conn.run, converted_query, **params)
-        
-        # Get column names from the cursor description
-        if conn.columns:
-            columns = [col["name"] for col in conn.columns]
-            return [dict(zip(columns, row)) for row in rows]
-        return []
+        rows = await conn.fetch(query, *args)
+        return [dict(row) for row in rows]
+
+
+async def execute_query_records(query: str, *args) -> list[asyncpg.Record]:
+    """
+    Execute a query and return the raw asyncpg Records.
+    
+    Records are tuple-like; unpack them positionally in SELECT order to
+    avoid building a dict per row.
+    """
+    async with get_connection() as conn:
+        return await conn.fetch(query, *args)
+
+
+async def execute_query_as(query: str, model_cls: type[ModelT], *args) -> list[ModelT]:
+    """
+    Execute a query and build model instances directly from the rows.
+    
+    Uses model_construct, which skips validation - only use it where the
+    column types already match the model fields.
+    """
+    async with get_connection() as conn:
+        rows = await conn.fetch(query, *args)
+        return [model_cls.model_construct(**row) for row in rows]
 
 
 async def execute_one(query: str, *args) -> Optional[dict]:
     """Execute a query and return single result."""
-    results = await execute_query(query, *args)
-    return results[0] if results else None
+    async with get_connection() as conn:
+        row = await conn.fetchrow(query, *args)
+        return dict(row) if row is not None else None
 
 
 async def execute_scalar(query: str, *args):
     """Execute a query and return scalar value."""
     async with get_connection() as conn:
-        converted_query, params = _convert_params(query, args)
-        rows = await asyncio.to_thread(conn.run, converted_query, **params)
-        if rows and rows[0]:
-            return rows[0][0]
-        return None
+        return await conn.fetchval(query, *args)
 
 
 async def execute_command(query: str, *args) -> str:
     """Execute a command and return status."""
     async with get_connection() as conn:
-        converted_query, params = _convert_params(query, args)
-        await asyncio.to_thread(conn.run, converted_query, **params)
-        return "OK"
+        return await conn.execute(query, *args)
@@ -8,10 +8,11 @@ import logging
 from typing import Optional, List
 from datetime import datetime
 
+import orjson
 from fastapi import APIRouter, HTTPException
-from pydantic import BaseModel
+from pydantic import BaseModel, TypeAdapter
 
-from app.db import execute_one, execute_query, execute_command
+from app.db import execute_one, execute_query, execute_query_as, execute_scalar
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
@@ -58,6 +59,10 @@ class BulkActionCreate(BaseModel):
     related_sources: Optional[list] = None
 
 
+# Validates a whole list of rows in one pass
+_ACTION_LIST_ADAPTER = TypeAdapter(List[ActionResponse])
+
+
 @router.get("/{patient_id}/actions", response_model=List[ActionResponse])
 async def get_patient_actions(
     patient_id: str,
@@ -79,29 +84,22 @@ async def get_patient_actions(
     
     query += " ORDER BY created_at DESC"
     
-    results = await execute_query(query, *params)
-    
-    return [ActionResponse(**row) for row in results]
+    return await execute_query_as(query, ActionResponse, *params)
 
 
 @router.post("/{patient_id}/actions", response_model=ActionResponse)
 async def create_action(patient_id: str, action: ActionCreate) -> ActionResponse:
     """Create a new clinical action for a patient."""
     
-    # Verify patient exists
-    patient = await execute_one(
-        "SELECT patient_id FROM patients WHERE patient_id = $1",
-        patient_id
-    )
-    if not patient:
-        raise HTTPException(status_code=404, detail=f"Patient {patient_id} not found")
-    
+    # Insert only if the patient exists (no row is returned otherwise)
     result = await execute_one(
         """
         INSERT INTO clinical_actions (
             patient_id, action_text, status, priority, source, original_ai_text,
             related_question, related_sources, created_by, doctor_notes
-        ) VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10)
+        )
+        SELECT $1, $2, $3, $4, $5, $6, $7, $8::jsonb, $9, $10
+        WHERE EXISTS (SELECT 1 FROM patients WHERE patient_id = $1)
         RETURNING action_id, patient_id, action_text, status, priority, source,
                   original_ai_text, created_by, created_at, updated_at, doctor_notes
         """,
@@ -117,6 +115,9 @@ async def create_action(patient_id: str, action: ActionCreate) -> ActionResponse
         action.doctor_notes
     )
     
+    if not result:
+        raise HTTPException(status_code=404, detail=f"Patient {patient_id} not found")
+    
     logger.info(f"Created action {result['action_id']} for patient {patient_id}")
     return ActionResponse(**result)
 
@@ -125,38 +126,55 @@ async def create_action(patient_id: str, action: ActionCreate) -> ActionResponse
 async def create_actions_bulk(patient_id: str, bulk: BulkActionCreate) -> List[ActionResponse]:
     """Create multiple clinical actions at once (for saving AI suggestions)."""
     
-    # Verify patient exists
-    patient = await execute_one(
-        "SELECT patient_id FROM patients WHERE patient_id = $1",
-        patient_id
+    actions = bulk.actions
+    if not actions:
+        # Nothing to insert, but an unknown patient is still a 404
+        exists = await execute_scalar(
+            "SELECT EXISTS(SELECT 1 FROM patients WHERE patient_id = $1)",
+            patient_id
+        )
+        if not exists:
+            raise HTTPException(status_code=404, detail=f"Patient {patient_id} not found")
+        return []
+    
+    # Insert all actions in one statement by unnesting parallel column arrays,
+    # only if the patient exists (no rows are returned otherwise)
+    related_sources = [bulk.related_sources or a.related_sources for a in actions]
+    results = await execute_query(
+        """
+        INSERT INTO clinical_actions (
+            patient_id, action_text, status, priority, source, original_ai_text,
+            related_question, related_sources, created_by, doctor_notes
+        )
+        SELECT $1, t.action_text, t.status, t.priority, t.source, t.original_ai_text,
+               t.related_question, t.related_sources::jsonb, t.created_by, t.doctor_notes
+        FROM UNNEST(
+            $2::text[], $3::text[], $4::text[], $5::text[], $6::text[],
+            $7::text[], $8::text[], $9::text[], $10::text[]
+        ) AS t(
+            action_text, status, priority, source, original_ai_text,
+            related_question, related_sources, created_by, doctor_notes
+        )
+        WHERE EXISTS (SELECT 1 FROM patients WHERE patient_id = $1)
+        RETURNING action_id, patient_id, action_text, status, priority, source,
+                  original_ai_text, created_by, created_at, updated_at, doctor_notes
+        """,
+        patient_id,
+        [a.action_text for a in actions],
+        [a.status for a in actions],
+        [a.priority for a in actions],
+        [a.source for a in actions],
+        [a.original_ai_text or a.action_text for a in actions],  # Store original if not provided
+        [bulk.related_question or a.related_question for a in actions],
+        [orjson.dumps(sources).decode() if sources is not None else None for sources in related_sources],
+        [a.created_by for a in actions],
+        [a.doctor_notes for a in actions]
     )
-    if not patient:
+    
+    if not results:
         raise HTTPException(status_code=404, detail=f"Patient {patient_id} not found")
     
-    created_actions = []
-    
-    for action in bulk.actions:
-        result = await execute_one(
-            """
-            INSERT INTO clinical_actions (
-                patient_id, action_text, status, priority, source, original_ai_text,
-                related_question, related_sources, created_by, doctor_notes
-            ) VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10)
-            RETURNING action_id, patient_id, action_text, status, priority, source,
-                      original_ai_text, created_by, created_at, updated_at, doctor_notes
-            """,
-            patient_id,
-            action.action_text,
-            action.status,
-            action.priority,
-            action.source,
-            action.original_ai_text or action.action_text,  # Store original if not provided
-            bulk.related_question or action.related_question,
-            bulk.related_sources or action.related_sources,
-            action.created_by,
-            action.doctor_notes
-        )
-        created_actions.append(ActionResponse(**result))
+    created_actions = _ACTION_LIST_ADAPTER.validate_python(results)
     
     logger.info(f"Created {len(created_actions)} actions for patient {patient_id}")
     return created_actions
@@ -170,58 +188,32 @@ async def update_action(
 ) -> ActionResponse:
     """Update a clinical action (edit text, change status, add notes)."""
     
-    # Build dynamic update query
-    updates = []
-    params = []
-    param_idx = 1
-    
-    if update.action_text is not None:
-        updates.append(f"action_text = ${param_idx}")
-        params.append(update.action_text)
-        param_idx += 1
-    
-    if update.status is not None:
-        updates.append(f"status = ${param_idx}")
-        params.append(update.status)
-        param_idx += 1
-        
-        # Set completed_at if status is completed
-        if update.status == "completed":
-            updates.append(f"completed_at = NOW()")
-    
-    if update.priority is not None:
-        updates.append(f"priority = ${param_idx}")
-        params.append(update.priority)
-        param_idx += 1
-    
-    if update.doctor_notes is not None:
-        updates.append(f"doctor_notes = ${param_idx}")
-        params.append(update.doctor_notes)
-        param_idx += 1
-    
-    if update.updated_by is not None:
-        updates.append(f"updated_by = ${param_idx}")
-        params.append(update.updated_by)
-        param_idx += 1
-    
-    if not updates:
+    if not update.model_dump(exclude_none=True):
         raise HTTPException(status_code=400, detail="No fields to update")
     
-    updates.append("updated_at = NOW()")
-    
-    # Add WHERE clause params
-    params.append(action_id)
-    params.append(patient_id)
-    
-    query = f"""
+    # Fixed statement: fields left as NULL keep their current value
+    result = await execute_one(
+        """
         UPDATE clinical_actions
-        SET {', '.join(updates)}
-        WHERE action_id = ${param_idx} AND patient_id = ${param_idx + 1}
+        SET action_text = COALESCE($1, action_text),
+            status = COALESCE($2, status),
+            priority = COALESCE($3, priority),
+            doctor_notes = COALESCE($4, doctor_notes),
+            updated_by = COALESCE($5, updated_by),
+            updated_at = NOW(),
+            completed_at = CASE WHEN $2 = 'completed' THEN NOW() ELSE completed_at END
+        WHERE action_id = $6 AND patient_id = $7
         RETURNING action_id, patient_id, action_text, status, priority, source,
                   original_ai_text, created_by, created_at, updated_at, doctor_notes
-    """
-    
-    result = await execute_one(query, *params)
+        """,
+        update.action_text,
+        update.status,
+        update.priority,
+        update.doctor_notes,
+        update.updated_by,
+        action_id,
+        patient_id
+    )
     
     if not result:
         raise HTTPException(status_code=404, detail=f"Action {action_id} not found")
@@ -5,9 +5,10 @@ RAG-based clinical Copilot with grounded answers and source citations.
 Supports both standard and streaming responses via SSE.
 """
 
-import json
+import asyncio
 import logging
 
+import orjson
 from fastapi import APIRouter, HTTPException
 from fastapi.responses import StreamingResponse
 
@@ -19,6 +20,22 @@ from app.services.llm import generate_answer, generate_answer_stream
 logger = logging.getLogger(__name__)
 router = APIRouter()
 
+# Max SSE events buffered between the answer producer and the client
+STREAM_BUFFER_SIZE = 64
+
+# Pre-encoded SSE frame parts
+_EVT_METADATA = b"event: metadata\ndata: "
+_EVT_ERROR = b"event: error\ndata: "
+_EVT_END = b"\n\n"
+
+
+async def _get_patient(patient_id: str):
+    """Look up the patient's display name (None if the patient does not exist)."""
+    return await execute_one(
+        "SELECT patient_id, display_name FROM patients WHERE patient_id = $1",
+        patient_id
+    )
+
 
 @router.post("/{patient_id}/copilot:ask", response_model=CopilotResponse)
 async def ask_copilot(patient_id: str, request: CopilotRequest) -> CopilotResponse:
@@ -30,11 +47,8 @@ async def ask_copilot(patient_id: str, request: CopilotRequest) -> CopilotRespon
     2. Generates a grounded answer using Azure OpenAI (or template fallback)
     3. Returns answer with citations to source records
     """
-    # Verify patient exists
-    patient = await execute_one(
-        "SELECT patient_id, display_name FROM patients WHERE patient_id = $1",
-        patient_id
-    )
+    # Verify patient exists (before any embedding or retrieval work)
+    patient = await _get_patient(patient_id)
     
     if not patient:
         raise HTTPException(status_code=404, detail=f"Patient {patient_id} not found")
@@ -49,7 +63,7 @@ async def ask_copilot(patient_id: str, request: CopilotRequest) -> CopilotRespon
         
         # Convert to CopilotSource objects
         sources = [
-            CopilotSource(
+            CopilotSource.model_construct(
                 source_type=r.get("source_type", "unknown"),
                 source_id=r.get("source_id", 0),
                 label=r.get("label", "Unknown source"),
@@ -102,16 +116,13 @@ async def stream_copilot(patient_id: str, request: CopilotRequest):
     
     This endpoint uses Azure OpenAI Responses API with stream=True.
     """
-    # Verify patient exists
-    patient = await execute_one(
-        "SELECT patient_id, display_name FROM patients WHERE patient_id = $1",
-        patient_id
-    )
+    # Verify patient exists (before any embedding or retrieval work)
+    patient = await _get_patient(patient_id)
     
     if not patient:
         raise HTTPException(status_code=404, detail=f"Patient {patient_id} not found")
     
-    async def generate_stream():
+    async def produce_events(queue: asyncio.Queue):
         try:
             # Step 1: Retrieve relevant context
             context_results, retrieval_method = await retrieve_context(
@@ -122,7 +133,7 @@ async def stream_copilot(patient_id: str, request: CopilotRequest):
             
             # Convert to CopilotSource objects
             sources = [
-                CopilotSource(
+                CopilotSource.model_construct(
                     source_type=r.get("source_type", "unknown"),
                     source_id=r.get("source_id", 0),
                     label=r.get("label", "Unknown source"),
@@ -134,7 +145,7 @@ async def stream_copilot(patient_id: str, request: CopilotRequest):
             ]
             
             # Send retrieval method info
-            yield f"event: metadata\ndata: {json.dumps({'retrieval_method': retrieval_method})}\n\n"
+            await queue.put(_EVT_METADATA + orjson.dumps({"retrieval_method": retrieval_method}) + _EVT_END)
             
             # Step 2: Stream the answer
             async for event_chunk in generate_answer_stream(
@@ -142,7 +153,7 @@ async def stream_copilot(patient_id: str, request: CopilotRequest):
                 patient_name=patient.get("display_name", "the patient"),
                 sources=sources
             ):
-                yield event_chunk
+                await queue.put(event_chunk)
                 
             logger.info(
                 f"Copilot streamed answer for patient {patient_id}: "
@@ -151,7 +162,21 @@ async def stream_copilot(patient_id: str, request: CopilotRequest):
             
         except Exception as e:
             logger.error(f"Error in streaming Copilot response: {str(e)}")
-            yield f"event: error\ndata: {json.dumps({'error': str(e)})}\n\n"
+            await queue.put(_EVT_ERROR + orjson.dumps({"error": str(e)}) + _EVT_END)
+        
+        # Signal end of stream
+        await queue.put(None)
+    
+    async def generate_stream():
+        # Run the answer producer in a background task so it keeps filling
+        # the buffer while a slow client drains it
+        queue: asyncio.Queue = asyncio.Queue(maxsize=STREAM_BUFFER_SIZE)
+        producer = asyncio.create_task(produce_events(queue))
+        try:
+            while (event_chunk := await queue.get()) is not None:
+                yield event_chunk
+        finally:
+            producer.cancel()
     
     return StreamingResponse(
         generate_stream(),
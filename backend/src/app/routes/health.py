@@ -2,7 +2,10 @@
 Patient 360 Backend - Health Check Route
 """
 
-from fastapi import APIRouter
+import asyncio
+import time
+
+from fastapi import APIRouter, Query
 
 from app.db import execute_scalar
 from app.settings import get_settings
@@ -10,26 +13,53 @@ from app.schemas import HealthResponse
 
 router = APIRouter()
 
+# Database probe results are reused for this long so frequent health probes
+# (load balancer, orchestrator) don't each run a query
+DB_PROBE_TTL_SECONDS = 2.0
+
+# Last database probe: (time.monotonic() timestamp, status)
+_last_db_probe: tuple[float, str] = (float("-inf"), "unknown")
+_db_probe_lock = asyncio.Lock()
+
+
+async def _check_database(force: bool = False) -> str:
+    """Return the database status, probing at most once per TTL."""
+    global _last_db_probe
+    
+    if not force and time.monotonic() - _last_db_probe[0] < DB_PROBE_TTL_SECONDS:
+        return _last_db_probe[1]
+    
+    # Concurrent callers wait for a single in-flight probe
+    async with _db_probe_lock:
+        checked_at, db_status = _last_db_probe
+        if not force and time.monotonic() - checked_at < DB_PROBE_TTL_SECONDS:
+            return db_status
+        
+        try:
+            result = await execute_scalar("SELECT 1")
+            if result == 1:
+                db_status = "healthy"
+            else:
+                db_status = "unhealthy: unexpected result"
+        except Exception as e:
+            db_status = f"unhealthy: {str(e)}"
+        
+        _last_db_probe = (time.monotonic(), db_status)
+        return db_status
+
 
 @router.get("/health", response_model=HealthResponse)
-async def health_check() -> HealthResponse:
+async def health_check(force: bool = Query(default=False)) -> HealthResponse:
     """
     Health check endpoint.
     
-    Returns the status of the API and its dependencies.
+    Returns the status of the API and its dependencies. The database probe
+    is cached for a couple of seconds; pass force=true to re-probe.
     """
     settings = get_settings()
     
     # Check database connection
-    db_status = "unknown"
-    try:
-        result = await execute_scalar("SELECT 1")
-        if result == 1:
-            db_status = "healthy"
-        else:
-            db_status = "unhealthy: unexpected result"
-    except Exception as e:
-        db_status = f"unhealthy: {str(e)}"
+    db_status = await _check_database(force=force)
     
     # Check Azure AI configuration
     azure_ai_status = "configured" if settings.azure_ai_endpoint else "not configured"
@@ -4,13 +4,16 @@ Patient 360 Backend - Note Ingestion Route
 Handles ingestion of clinical notes through the PHI-safe pipeline.
 """
 
-import json
+import asyncio
 import logging
+from typing import Optional
 
 from fastapi import APIRouter, HTTPException
 
-from app.db import execute_one, execute_scalar, execute_query, execute_command, get_connection
+from app.db import execute_one, execute_query
+from app.settings import get_settings
 from app.schemas import NoteIngestRequest, NoteIngestResponse
+from app.services.retrieval import invalidate_patient_context
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
@@ -29,51 +32,56 @@ async def ingest_note(patient_id: str, request: NoteIngestRequest) -> NoteIngest
     
     All processing happens in the database via the ingest_note() SQL function.
     """
-    # Verify patient exists
-    patient = await execute_one(
-        "SELECT patient_id FROM patients WHERE patient_id = $1",
-        patient_id
-    )
-    
-    if not patient:
-        raise HTTPException(status_code=404, detail=f"Patient {patient_id} not found")
-    
-    # Validate encounter if provided
-    if request.encounter_id:
-        encounter = await execute_one(
-            "SELECT encounter_id FROM encounters WHERE encounter_id = $1 AND patient_id = $2",
-            request.encounter_id, patient_id
-        )
-        if not encounter:
-            raise HTTPException(
-                status_code=400, 
-                detail=f"Encounter {request.encounter_id} not found for patient {patient_id}"
-            )
-    
     try:
-        # Call the ingest_note SQL function
-        note_id = await execute_scalar(
-            "SELECT ingest_note($1, $2, $3, $4, $5)",
+        # Validate the patient and encounter, then call the ingest_note SQL
+        # function, all in one statement (ingest_note only runs if both pass)
+        result = await execute_one(
+            """
+            SELECT
+                p.found AS patient_found,
+                e.found AS encounter_found,
+                CASE WHEN p.found AND e.found
+                    THEN ingest_note($1, $2, $3, $4, $5)
+                END AS note_id
+            FROM (
+                SELECT EXISTS (SELECT 1 FROM patients WHERE patient_id = $1) AS found
+            ) p,
+            (
+                SELECT $2::bigint IS NULL OR EXISTS (
+                    SELECT 1 FROM encounters WHERE encounter_id = $2 AND patient_id = $1
+                ) AS found
+            ) e
+            """,
             patient_id,
-            request.encounter_id,
+            request.encounter_id or None,  # 0 means no encounter, as before
             request.raw_text,
             request.note_type,
             request.author
         )
         
+        if not result["patient_found"]:
+            raise HTTPException(status_code=404, detail=f"Patient {patient_id} not found")
+        
+        if not result["encounter_found"]:
+            raise HTTPException(
+                status_code=400, 
+                detail=f"Encounter {request.encounter_id} not found for patient {patient_id}"
+            )
+        
+        note_id = result["note_id"]
+        
         if not note_id:
             raise HTTPException(status_code=500, detail="Failed to ingest note")
         
+        invalidate_patient_context(patient_id)
+        
         # Get PHI entity count
         phi_result = await execute_one(
             "SELECT phi_entities FROM notes_phi WHERE note_id = $1",
             note_id
         )
         
-        phi_entities = phi_result.get("phi_entities", []) if phi_result else []
-        if isinstance(phi_entities, str):
-            phi_entities = json.loads(phi_entities)
-        
+        phi_entities = phi_result.get("phi_entities") if phi_result else None
         phi_count = len(phi_entities) if phi_entities else 0
         
         logger.info(f"Successfully ingested note {note_id} for patient {patient_id}, detected {phi_count} PHI entities")
@@ -85,6 +93,9 @@ async def ingest_note(patient_id: str, request: NoteIngestRequest) -> NoteIngest
             phi_entity_count=phi_count
         )
         
+    except HTTPException:
+        raise
+    
     except Exception as e:
         logger.error(f"Error ingesting note for patient {patient_id}: {str(e)}")
         
@@ -108,61 +119,73 @@ async def reprocess_notes(patient_id: str) -> dict:
     Useful if Azure AI was not configured during initial ingestion
     and you want to regenerate redacted notes with proper PHI detection.
     """
-    # Verify patient exists
-    patient = await execute_one(
-        "SELECT patient_id FROM patients WHERE patient_id = $1",
+    # Get all raw notes for the patient (one row with NULL note_id if the
+    # patient has no notes, no rows if the patient does not exist)
+    rows = await execute_query(
+        """
+        SELECT nr.note_id, nr.encounter_id, nr.raw_text, nr.note_type, nr.author
+        FROM patients p
+        LEFT JOIN notes_raw nr ON nr.patient_id = p.patient_id
+        WHERE p.patient_id = $1
+        """,
         patient_id
     )
     
-    if not patient:
+    if not rows:
         raise HTTPException(status_code=404, detail=f"Patient {patient_id} not found")
     
-    # Get all raw notes for the patient
-    raw_notes = await execute_query(
-        "SELECT note_id, encounter_id, raw_text, note_type, author FROM notes_raw WHERE patient_id = $1",
-        patient_id
-    )
+    raw_notes = [row for row in rows if row["note_id"] is not None]
     
     if not raw_notes:
         return {"message": "No notes found to reprocess", "processed": 0}
     
-    processed = 0
-    errors = []
+    # Reprocess notes concurrently, using at most half the connection pool so
+    # other endpoints (and the health probe) still get connections while the
+    # slow redact/embed calls run
+    max_concurrency = max(1, get_settings().db_pool_max_size // 2)
+    semaphore = asyncio.Semaphore(min(len(raw_notes), max_concurrency))
     
-    for note in raw_notes:
-        try:
-            # Delete existing PHI note if exists
-            await execute_command(
-                "DELETE FROM notes_phi WHERE note_id = $1",
-                note["note_id"]
-            )
-            
-            # Reprocess through ingest (but note already exists in raw)
-            # We need to call redact and embed directly
-            result = await execute_one(
-                """
-                WITH redaction AS (
-                    SELECT * FROM redact_phi($1, 'en')
+    async def reprocess_note(note: dict) -> tuple[bool, Optional[dict]]:
+        """Reprocess one note. Returns (processed, error)."""
+        async with semaphore:
+            try:
+                # Reprocess through ingest (but note already exists in raw)
+                # We need to call redact and embed directly, replacing any
+                # existing PHI note in the same statement
+                result = await execute_one(
+                    """
+                    WITH redaction AS (
+                        SELECT * FROM redact_phi($1, 'en')
+                    )
+                    INSERT INTO notes_phi (note_id, patient_id, encounter_id, redacted_text, phi_entities, embedding)
+                    SELECT 
+                        $2,
+                        $3,
+                        $4,
+                        r.redacted_text,
+                        r.phi_entities,
+                        generate_embedding(r.redacted_text)
+                    FROM redaction r
+                    ON CONFLICT (note_id) DO UPDATE SET
+                        encounter_id = EXCLUDED.encounter_id,
+                        redacted_text = EXCLUDED.redacted_text,
+                        phi_entities = EXCLUDED.phi_entities,
+                        embedding = EXCLUDED.embedding
+                    RETURNING note_id
+                    """,
+                    note["raw_text"], note["note_id"], patient_id, note.get("encounter_id")
                 )
-                INSERT INTO notes_phi (note_id, patient_id, encounter_id, redacted_text, phi_entities, embedding)
-                SELECT 
-                    $2,
-                    $3,
-                    $4,
-                    r.redacted_text,
-                    r.phi_entities,
-                    generate_embedding(r.redacted_text)
-                FROM redaction r
-                RETURNING note_id
-                """,
-                note["raw_text"], note["note_id"], patient_id, note.get("encounter_id")
-            )
-            
-            if result:
-                processed += 1
                 
-        except Exception as e:
-            errors.append({"note_id": note["note_id"], "error": str(e)})
+                return result is not None, None
+                
+            except Exception as e:
+                return False, {"note_id": note["note_id"], "error": str(e)}
+    
+    results = await asyncio.gather(*(reprocess_note(note) for note in raw_notes))
+    invalidate_patient_context(patient_id)
+    
+    processed = sum(1 for ok, _ in results if ok)
+    errors = [error for _, error in results if error]
     
     return {
         "message": f"Reprocessed {processed} of {len(raw_notes)} notes",
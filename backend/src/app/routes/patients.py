@@ -4,26 +4,40 @@ Patient 360 Backend - Patient Routes
 Endpoints for patient snapshot and timeline data.
 """
 
-import json
 import logging
+import time
+from collections import OrderedDict
 from typing import Optional
 
-from fastapi import APIRouter, HTTPException, Query
+from fastapi import APIRouter, HTTPException, Query, Response
+from pydantic import TypeAdapter
 
-from app.db import execute_one, execute_query
+from app.db import execute_one, execute_query_as, execute_scalar
 from app.settings import get_settings
 from app.schemas import (
-    PatientSnapshot, PatientBase, Problem, Allergy, 
-    Medication, Vital, TimelineResponse, TimelineEvent,
-    NoteDetail
+    PatientSnapshot, Medication, Vital, TimelineResponse, TimelineEvent, NoteDetail
 )
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
 
+_SETTINGS = get_settings()
+
+_TIMELINE_EVENTS_ADAPTER = TypeAdapter(list[TimelineEvent])
+
+# Snapshots are cached briefly per patient, since the dashboard requests
+# the same snapshot repeatedly during a session. The cache is purely
+# TTL-based: writes are not tracked, so a snapshot may be up to
+# SNAPSHOT_CACHE_TTL_SECONDS stale.
+SNAPSHOT_CACHE_TTL_SECONDS = 15.0
+SNAPSHOT_CACHE_MAX_ENTRIES = 1024
+
+# patient_id -> (time.monotonic() expiry, snapshot JSON bytes)
+_snapshot_cache: OrderedDict[str, tuple[float, bytes]] = OrderedDict()
+
 
 @router.get("/{patient_id}/snapshot", response_model=PatientSnapshot)
-async def get_patient_snapshot(patient_id: str) -> PatientSnapshot:
+async def get_patient_snapshot(patient_id: str) -> Response:
     """
     Get comprehensive patient snapshot for the dashboard.
     
@@ -33,53 +47,36 @@ async def get_patient_snapshot(patient_id: str) -> PatientSnapshot:
     - Allergies
     - Active medications
     - Key vitals (BP, A1C, eGFR, etc.)
+    
+    The JSON document built by the database function is validated straight
+    from its text form (no intermediate dicts), so the response keeps the
+    PatientSnapshot shape, and the serialized body is cached.
     """
-    settings = get_settings()
+    cached = _snapshot_cache.get(patient_id)
+    if cached and cached[0] > time.monotonic():
+        _snapshot_cache.move_to_end(patient_id)
+        return Response(content=cached[1], media_type="application/json")
     
-    # Call the database function
-    result = await execute_one(
-        "SELECT get_patient_snapshot($1) as snapshot",
-        patient_id
+    # Call the database function (no row if the patient does not exist)
+    snapshot = await execute_scalar(
+        """
+        SELECT (s || jsonb_build_object('allow_raw_view', $2::boolean))::text
+        FROM get_patient_snapshot($1) AS s
+        WHERE jsonb_typeof(s->'patient') = 'object'
+        """,
+        patient_id, _SETTINGS.demo_allow_raw
     )
     
-    if not result or not result.get("snapshot"):
+    if not snapshot:
         raise HTTPException(status_code=404, detail=f"Patient {patient_id} not found")
     
-    snapshot_data = result["snapshot"]
+    content = PatientSnapshot.model_validate_json(snapshot).model_dump_json().encode()
+    _snapshot_cache[patient_id] = (time.monotonic() + SNAPSHOT_CACHE_TTL_SECONDS, content)
+    _snapshot_cache.move_to_end(patient_id)
+    while len(_snapshot_cache) > SNAPSHOT_CACHE_MAX_ENTRIES:
+        _snapshot_cache.popitem(last=False)
     
-    # Handle if snapshot_data is a string (JSON)
-    if isinstance(snapshot_data, str):
-        snapshot_data = json.loads(snapshot_data)
-    
-    # Check if patient data exists
-    if not snapshot_data.get("patient"):
-        raise HTTPException(status_code=404, detail=f"Patient {patient_id} not found")
-    
-    patient_data = snapshot_data["patient"]
-    
-    return PatientSnapshot(
-        patient=PatientBase(
-            patient_id=patient_data.get("patient_id", patient_id),
-            display_name=patient_data.get("display_name", "Unknown"),
-            dob=patient_data.get("dob"),
-            sex=patient_data.get("sex", "U"),
-            mrn=patient_data.get("mrn", ""),
-            age=patient_data.get("age")
-        ),
-        problems=[
-            Problem(**p) for p in snapshot_data.get("problems", [])
-        ],
-        allergies=[
-            Allergy(**a) for a in snapshot_data.get("allergies", [])
-        ],
-        active_medications=[
-            Medication(**m) for m in snapshot_data.get("active_medications", [])
-        ],
-        key_vitals=[
-            Vital(**v) for v in snapshot_data.get("key_vitals", [])
-        ],
-        allow_raw_view=settings.demo_allow_raw
-    )
+    return Response(content=content, media_type="application/json")
 
 
 @router.get("/{patient_id}/timeline", response_model=TimelineResponse)
@@ -91,44 +88,29 @@ async def get_patient_timeline(
     Get chronological timeline of clinical events.
     
     Includes encounters, notes, observations, and medication changes.
+    The events array built by the database function is validated straight
+    from its text form.
     """
-    # Verify patient exists
-    patient = await execute_one(
-        "SELECT patient_id FROM patients WHERE patient_id = $1",
-        patient_id
-    )
-    
-    if not patient:
-        raise HTTPException(status_code=404, detail=f"Patient {patient_id} not found")
-    
-    # Get timeline from database function
+    # Get timeline from database function, verifying the patient exists
+    # in the same round-trip
     result = await execute_one(
-        "SELECT get_patient_timeline($1, $2) as timeline",
+        """
+        SELECT
+            EXISTS (SELECT 1 FROM patients WHERE patient_id = $1) AS patient_found,
+            t::text AS events,
+            jsonb_array_length(t) AS total_count
+        FROM get_patient_timeline($1, $2) AS t
+        """,
         patient_id, limit
     )
     
-    timeline_data = result.get("timeline", []) if result else []
-    
-    # Handle if timeline_data is a string (JSON)
-    if isinstance(timeline_data, str):
-        timeline_data = json.loads(timeline_data)
-    
-    events = [
-        TimelineEvent(
-            event_type=e.get("event_type", "unknown"),
-            event_id=e.get("event_id", 0),
-            event_time=e.get("event_time"),
-            event_subtype=e.get("event_subtype"),
-            description=e.get("description"),
-            details=e.get("details")
-        )
-        for e in timeline_data
-    ]
-    
-    return TimelineResponse(
+    if not result["patient_found"]:
+        raise HTTPException(status_code=404, detail=f"Patient {patient_id} not found")
+    
+    return TimelineResponse.model_construct(
         patient_id=patient_id,
-        events=events,
-        total_count=len(events)
+        events=_TIMELINE_EVENTS_ADAPTER.validate_json(result["events"]),
+        total_count=result["total_count"]
     )
 
 
@@ -143,48 +125,49 @@ async def get_note(
     
     Raw text is only included if DEMO_ALLOW_RAW is true AND include_raw is requested.
     """
-    settings = get_settings()
-    
-    # Get PHI-redacted note
-    note = await execute_one(
+    # Get PHI-redacted note (raw text is only fetched when it will be returned)
+    if _SETTINGS.demo_allow_raw and include_raw:
+        query = """
+            SELECT 
+                np.note_id,
+                np.patient_id,
+                np.encounter_id,
+                np.redacted_text,
+                np.phi_entities,
+                np.created_at,
+                nr.note_type,
+                nr.raw_text
+            FROM notes_phi np
+            JOIN notes_raw nr ON nr.note_id = np.note_id
+            WHERE np.patient_id = $1 AND np.note_id = $2
         """
-        SELECT 
-            np.note_id,
-            np.patient_id,
-            np.encounter_id,
-            np.redacted_text,
-            np.phi_entities,
-            np.created_at,
-            nr.note_type,
-            nr.raw_text
-        FROM notes_phi np
-        JOIN notes_raw nr ON nr.note_id = np.note_id
-        WHERE np.patient_id = $1 AND np.note_id = $2
-        """,
-        patient_id, note_id
-    )
+    else:
+        query = """
+            SELECT 
+                np.note_id,
+                np.patient_id,
+                np.encounter_id,
+                np.redacted_text,
+                np.phi_entities,
+                np.created_at,
+                (SELECT nr.note_type FROM notes_raw nr WHERE nr.note_id = np.note_id) AS note_type
+            FROM notes_phi np
+            WHERE np.patient_id = $1 AND np.note_id = $2
+        """
+    note = await execute_one(query, patient_id, note_id)
     
     if not note:
         raise HTTPException(status_code=404, detail=f"Note {note_id} not found")
     
-    # Only include raw text if allowed and requested
-    raw_text = None
-    if settings.demo_allow_raw and include_raw:
-        raw_text = note.get("raw_text")
-    
-    phi_entities = note.get("phi_entities", [])
-    if isinstance(phi_entities, str):
-        phi_entities = json.loads(phi_entities)
-    
-    return NoteDetail(
+    return NoteDetail.model_construct(
         note_id=note["note_id"],
         patient_id=note["patient_id"],
         encounter_id=note.get("encounter_id"),
         note_type=note.get("note_type"),
         created_at=note["created_at"],
-        raw_text=raw_text,
+        raw_text=note.get("raw_text"),
         redacted_text=note["redacted_text"],
-        phi_entities=phi_entities if settings.demo_allow_raw else None
+        phi_entities=note.get("phi_entities") if _SETTINGS.demo_allow_raw else None
     )
 
 
@@ -202,7 +185,7 @@ async def get_medications(
             WHERE patient_id = $1 AND status = $2
             ORDER BY start_date DESC
         """
-        results = await execute_query(query, patient_id, status)
+        results = await execute_query_as(query, Medication, patient_id, status)
     else:
         query = """
             SELECT med_id, name, dose, frequency, status, start_date, end_date, prescriber, reason
@@ -210,9 +193,9 @@ async def get_medications(
             WHERE patient_id = $1
             ORDER BY start_date DESC
         """
-        results = await execute_query(query, patient_id)
+        results = await execute_query_as(query, Medication, patient_id)
     
-    return [Medication(**med) for med in results]
+    return results
 
 
 @router.get("/{patient_id}/observations", response_model=list[Vital])
@@ -232,7 +215,7 @@ async def get_observations(
             WHERE patient_id = $1 AND code = $2
             ORDER BY observed_at DESC LIMIT $3
         """
-        results = await execute_query(query, patient_id, code, limit)
+        results = await execute_query_as(query, Vital, patient_id, code, limit)
     else:
         query = """
             SELECT code, display, 
@@ -242,6 +225,6 @@ async def get_observations(
             WHERE patient_id = $1
             ORDER BY observed_at DESC LIMIT $2
         """
-        results = await execute_query(query, patient_id, limit)
+        results = await execute_query_as(query, Vital, patient_id, limit)
     
-    return [Vital(**obs) for obs in results]
+    return results
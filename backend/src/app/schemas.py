@@ -6,7 +6,12 @@ Defines all request/response models for the API.
 
 from datetime import date, datetime
 from typing import Any, Optional
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field
+
+
+# Config for read-only models built from database rows: instances are
+# immutable, and validators are compiled on first use rather than at import
+READ_ONLY_CONFIG = ConfigDict(frozen=True, defer_build=True)
 
 
 # =============================================================================
@@ -15,6 +20,8 @@ from pydantic import BaseModel, Field
 
 class PatientBase(BaseModel):
     """Base patient information."""
+    model_config = READ_ONLY_CONFIG
+    
     patient_id: str
     display_name: str
     dob: date
@@ -25,6 +32,8 @@ class PatientBase(BaseModel):
 
 class Problem(BaseModel):
     """Patient problem/diagnosis."""
+    model_config = READ_ONLY_CONFIG
+    
     problem_id: int
     display: str
     status: str
@@ -33,6 +42,8 @@ class Problem(BaseModel):
 
 class Allergy(BaseModel):
     """Patient allergy record."""
+    model_config = READ_ONLY_CONFIG
+    
     allergy_id: int
     substance: str
     reaction: Optional[str] = None
@@ -41,6 +52,8 @@ class Allergy(BaseModel):
 
 class Medication(BaseModel):
     """Patient medication record."""
+    model_config = READ_ONLY_CONFIG
+    
     med_id: int
     name: str
     dose: Optional[str] = None
@@ -54,6 +67,8 @@ class Medication(BaseModel):
 
 class Vital(BaseModel):
     """Patient vital sign / observation."""
+    model_config = READ_ONLY_CONFIG
+    
     code: str
     display: str
     value: Optional[str] = None
@@ -77,6 +92,8 @@ class PatientSnapshot(BaseModel):
 
 class TimelineEvent(BaseModel):
     """Single timeline event."""
+    model_config = READ_ONLY_CONFIG
+    
     event_type: str  # encounter, note, observation, medication
     event_id: int
     event_time: datetime
@@ -114,6 +131,8 @@ class NoteIngestResponse(BaseModel):
 
 class NoteDetail(BaseModel):
     """Detailed note information."""
+    model_config = READ_ONLY_CONFIG
+    
     note_id: int
     patient_id: str
     encounter_id: Optional[int] = None
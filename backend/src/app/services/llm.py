@@ -6,47 +6,97 @@ Supports both standard and streaming responses.
 """
 
 import asyncio
-import json
 import logging
+import re
+from functools import lru_cache
 from typing import AsyncGenerator, Optional, Tuple
 
-from openai import OpenAI
+import orjson
+from openai import AsyncOpenAI
+from pydantic import TypeAdapter
 
 from app.settings import get_settings
 from app.schemas import CopilotSource
 
 logger = logging.getLogger(__name__)
 
+# Pre-encoded SSE frame parts
+_EVT_SOURCE = b"event: source\ndata: "
+_EVT_DELTA = b"event: delta\ndata: "
+_EVT_ACTIONS = b"event: actions\ndata: "
+_EVT_DONE = b"event: done\ndata: "
+_EVT_ERROR = b"event: error\ndata: "
+_EVT_END = b"\n\n"
 
-def _create_azure_openai_client(settings) -> OpenAI:
+# Serializes a source straight to JSON bytes, without building an intermediate dict
+_SOURCE_ADAPTER = TypeAdapter(CopilotSource)
+
+
+def _encode_source_frame(source: CopilotSource) -> bytes:
+    """Encode a source citation as an SSE source frame."""
+    return _EVT_SOURCE + _SOURCE_ADAPTER.dump_json(source) + _EVT_END
+
+
+@lru_cache(maxsize=1)
+def _get_base_openai_client() -> AsyncOpenAI:
     """
-    Create an OpenAI client using Entra ID auth (DefaultAzureCredential)
-    if no API key is provided, otherwise use the API key.
+    Build the shared async OpenAI client for the Azure OpenAI /v1 endpoint.
     
-    Note: A new client is created per-request, so the token is always fresh.
+    Created once so every request reuses the same connection pool
+    (keep-alive and TLS sessions to Azure OpenAI).
     """
+    settings = get_settings()
     endpoint = settings.azure_openai_endpoint.rstrip('/')
     base_url = f"{endpoint}/openai/v1/"
 
     if settings.azure_openai_key:
         # Key-based auth
-        return OpenAI(api_key=settings.azure_openai_key, base_url=base_url)
-    else:
-        # Entra ID (Azure AD) token-based auth
-        from azure.identity import DefaultAzureCredential, get_bearer_token_provider
-        credential = DefaultAzureCredential()
-        token_provider = get_bearer_token_provider(
-            credential, "https://cognitiveservices.azure.com/.default"
-        )
-        token = token_provider()
-        logger.info("Using Entra ID authentication for Azure OpenAI")
-        return OpenAI(
-            api_key="entra-id-auth",  # placeholder, not used with bearer token
-            base_url=base_url,
-            default_headers={
-                "Authorization": f"Bearer {token}"
-            },
-        )
+        return AsyncOpenAI(api_key=settings.azure_openai_key, base_url=base_url)
+
+    # Entra ID (Azure AD) token-based auth - bearer token is added per request
+    logger.info("Using Entra ID authentication for Azure OpenAI")
+    return AsyncOpenAI(
+        api_key="entra-id-auth",  # placeholder, not used with bearer token
+        base_url=base_url,
+    )
+
+
+@lru_cache(maxsize=1)
+def _get_entra_token_provider():
+    """Build the shared Entra ID bearer token provider (caches and refreshes tokens)."""
+    from azure.identity import DefaultAzureCredential, get_bearer_token_provider
+    credential = DefaultAzureCredential()
+    return get_bearer_token_provider(
+        credential, "https://cognitiveservices.azure.com/.default"
+    )
+
+
+async def _create_azure_openai_client(settings) -> AsyncOpenAI:
+    """
+    Get an OpenAI client using Entra ID auth (DefaultAzureCredential)
+    if no API key is provided, otherwise use the API key.
+    
+    Note: With Entra ID, the shared client is copied with a fresh bearer
+    token per request; the copy still shares the underlying connection pool.
+    """
+    client = _get_base_openai_client()
+
+    if settings.azure_openai_key:
+        return client
+
+    # The token provider is synchronous and does blocking HTTP when it
+    # refreshes the token, so keep it off the event loop
+    token = await asyncio.to_thread(_get_entra_token_provider())
+    return client.with_options(default_headers={"Authorization": f"Bearer {token}"})
+
+
+# Upper-case labels for the known source types
+_SOURCE_TYPE_LABELS = {"note": "NOTE", "lab": "LAB", "med": "MED"}
+
+
+def _source_type_label(source_type: str) -> str:
+    """Return the upper-case display label for a source type."""
+    return _SOURCE_TYPE_LABELS.get(source_type) or source_type.upper()
 
 
 # System instructions for clinical copilot
@@ -78,11 +128,10 @@ def _build_context_and_prompt(
         Tuple of (context string, user input prompt)
     """
     # Build context from sources
-    context_parts = []
-    for i, source in enumerate(sources, 1):
-        context_parts.append(
-            f"[Source {i} - {source.source_type.upper()}] {source.label}:\n{source.snippet}"
-        )
+    context_parts = [
+        f"[Source {i} - {_source_type_label(source.source_type)}] {source.label}:\n{source.snippet}"
+        for i, source in enumerate(sources, 1)
+    ]
     
     context = "\n\n".join(context_parts) if context_parts else "No relevant context found."
     
@@ -139,22 +188,19 @@ async def _generate_with_openai(
     
     try:
         # Responses API uses the standard OpenAI client with /openai/v1/ base_url
-        client = _create_azure_openai_client(settings)
+        client = await _create_azure_openai_client(settings)
         
         # Build context and prompt using shared helper
         _, user_input = _build_context_and_prompt(question, patient_name, sources)
 
-        # Use the Responses API (sync call wrapped in asyncio.to_thread)
-        def _call_responses_api():
-            return client.responses.create(
-                model=settings.azure_openai_chat_deployment,
-                instructions=SYSTEM_INSTRUCTIONS,
-                input=user_input,
-                max_output_tokens=1000,
-                temperature=0.3
-            )
-        
-        response = await asyncio.to_thread(_call_responses_api)
+        # Use the Responses API (awaited natively on the event loop)
+        response = await client.responses.create(
+            model=settings.azure_openai_chat_deployment,
+            instructions=SYSTEM_INSTRUCTIONS,
+            input=user_input,
+            max_output_tokens=1000,
+            temperature=0.3
+        )
         
         # Extract text from Responses API output
         response_text = response.output_text
@@ -177,12 +223,12 @@ async def generate_answer_stream(
     question: str,
     patient_name: str,
     sources: list[CopilotSource]
-) -> AsyncGenerator[str, None]:
+) -> AsyncGenerator[bytes, None]:
     """
     Generate a grounded answer to a clinical question with streaming.
     
     Uses Azure OpenAI Responses API streaming mode.
-    Yields Server-Sent Events (SSE) formatted strings.
+    Yields Server-Sent Events (SSE) frames as bytes.
     
     Event types:
     - source: Source citations
@@ -199,36 +245,29 @@ async def generate_answer_stream(
         
         # Send sources first
         for source in sources:
-            source_data = {
-                "source_type": source.source_type,
-                "source_id": source.source_id,
-                "label": source.label,
-                "snippet": source.snippet,
-                "score": source.score,
-                "metadata": source.metadata
-            }
-            yield f"event: source\ndata: {json.dumps(source_data)}\n\n"
+            yield _encode_source_frame(source)
         
         # Send the full answer as chunks (simulate streaming)
         words = answer.split()
         for i in range(0, len(words), 3):
             chunk = " ".join(words[i:i+3]) + " "
-            yield f"event: delta\ndata: {json.dumps({'text': chunk})}\n\n"
-            await asyncio.sleep(0.02)  # Small delay for effect
+            yield _EVT_DELTA + orjson.dumps({"text": chunk}) + _EVT_END
+            if settings.demo_fake_streaming:
+                await asyncio.sleep(0.02)  # Small delay for effect
         
         # Send actions
-        yield f"event: actions\ndata: {json.dumps({'actions': next_actions})}\n\n"
-        yield f"event: done\ndata: {json.dumps({'model': None, 'retrieval_method': 'template'})}\n\n"
+        yield _EVT_ACTIONS + orjson.dumps({"actions": next_actions}) + _EVT_END
+        yield _EVT_DONE + orjson.dumps({"model": None, "retrieval_method": "template"}) + _EVT_END
         return
     
     try:
         # Stream from Azure OpenAI Responses API
-        async for event_str in _stream_with_openai(question, patient_name, sources, settings):
-            yield event_str
+        async for event_frame in _stream_with_openai(question, patient_name, sources, settings):
+            yield event_frame
             
     except Exception as e:
         logger.error(f"Streaming error: {str(e)}")
-        yield f"event: error\ndata: {json.dumps({'error': str(e)})}\n\n"
+        yield _EVT_ERROR + orjson.dumps({"error": str(e)}) + _EVT_END
 
 
 async def _stream_with_openai(
@@ -236,60 +275,48 @@ async def _stream_with_openai(
     patient_name: str,
     sources: list[CopilotSource],
     settings
-) -> AsyncGenerator[str, None]:
+) -> AsyncGenerator[bytes, None]:
     """Stream answer using Azure OpenAI Responses API with stream=True."""
     
     # Setup client
-    client = _create_azure_openai_client(settings)
+    client = await _create_azure_openai_client(settings)
     
     # First, send all sources
     for source in sources:
-        source_data = {
-            "source_type": source.source_type,
-            "source_id": source.source_id,
-            "label": source.label,
-            "snippet": source.snippet,
-            "score": source.score,
-            "metadata": source.metadata
-        }
-        yield f"event: source\ndata: {json.dumps(source_data)}\n\n"
+        yield _encode_source_frame(source)
     
     # Build context and prompt using shared helper
     _, user_input = _build_context_and_prompt(question, patient_name, sources)
 
     # Call Responses API with streaming
-    def _call_streaming_api():
-        return client.responses.create(
-            model=settings.azure_openai_chat_deployment,
-            instructions=SYSTEM_INSTRUCTIONS,
-            input=user_input,
-            max_output_tokens=1000,
-            temperature=0.3,
-            stream=True
-        )
-    
-    # Run the blocking API call in a thread
-    stream = await asyncio.to_thread(_call_streaming_api)
+    stream = await client.responses.create(
+        model=settings.azure_openai_chat_deployment,
+        instructions=SYSTEM_INSTRUCTIONS,
+        input=user_input,
+        max_output_tokens=1000,
+        temperature=0.3,
+        stream=True
+    )
     
     # Collect full response for parsing actions at the end
     full_text = ""
     
     # Stream the events
-    for event in stream:
+    async for event in stream:
         if event.type == 'response.output_text.delta':
             # Send text delta
             delta_text = event.delta
             full_text += delta_text
-            yield f"event: delta\ndata: {json.dumps({'text': delta_text})}\n\n"
+            yield _EVT_DELTA + orjson.dumps({"text": delta_text}) + _EVT_END
     
     # Parse the full response to extract next actions
     _, next_actions = _parse_llm_response(full_text)
     
     # Send actions
-    yield f"event: actions\ndata: {json.dumps({'actions': next_actions})}\n\n"
+    yield _EVT_ACTIONS + orjson.dumps({"actions": next_actions}) + _EVT_END
     
     # Send done event
-    yield f"event: done\ndata: {json.dumps({'model': settings.azure_openai_chat_deployment, 'retrieval_method': 'vector'})}\n\n"
+    yield _EVT_DONE + orjson.dumps({"model": settings.azure_openai_chat_deployment, "retrieval_method": "vector"}) + _EVT_END
     
     logger.info(f"Streamed answer using Azure OpenAI Responses API ({settings.azure_openai_chat_deployment})")
 
@@ -297,36 +324,25 @@ async def _stream_with_openai(
 def _parse_llm_response(response_text: str) -> Tuple[str, list[str]]:
     """Parse LLM response into answer and next actions."""
     
-    answer = ""
-    next_actions = []
+    # Split by NEXT ACTIONS marker (a repeated marker ends the actions section)
+    answer_part, actions_marker, actions_part = response_text.partition("NEXT ACTIONS:")
+    actions_part = actions_part.partition("NEXT ACTIONS:")[0]
     
-    # Split by NEXT ACTIONS marker
-    if "NEXT ACTIONS:" in response_text:
-        parts = response_text.split("NEXT ACTIONS:")
-        answer_part = parts[0]
-        actions_part = parts[1] if len(parts) > 1 else ""
-        
-        # Extract answer
-        if "ANSWER:" in answer_part:
-            answer = answer_part.split("ANSWER:")[1].strip()
-        else:
-            answer = answer_part.strip()
-        
+    # Extract answer (a repeated marker ends the answer)
+    _, answer_marker, answer = answer_part.partition("ANSWER:")
+    answer = (answer.partition("ANSWER:")[0] if answer_marker else answer_part).strip()
+    
+    if actions_marker:
         # Extract actions
-        for line in actions_part.strip().split("\n"):
+        next_actions = []
+        for line in actions_part.split("\n"):
             line = line.strip()
-            if line.startswith("-") or line.startswith("•"):
+            if line.startswith(("-", "•")):
                 action = line.lstrip("-•").strip()
                 if action:
                     next_actions.append(action)
     else:
-        # No structured format, use entire response as answer
-        if "ANSWER:" in response_text:
-            answer = response_text.split("ANSWER:")[1].strip()
-        else:
-            answer = response_text.strip()
-        
-        # Generate default next actions
+        # No structured format, generate default next actions
         next_actions = [
             "Review full clinical context",
             "Document assessment in patient record",
@@ -336,55 +352,85 @@ def _parse_llm_response(response_text: str) -> Tuple[str, list[str]]:
     return answer, next_actions
 
 
-def _generate_template_response(
-    question: str,
-    patient_name: str,
-    sources: list[CopilotSource]
-) -> Tuple[str, list[str], None]:
-    """Generate a template-based response when Azure OpenAI is not available."""
-    
-    question_lower = question.lower()
-    
-    # Build source summary
-    note_sources = [s for s in sources if s.source_type == "note"]
-    lab_sources = [s for s in sources if s.source_type == "lab"]
-    med_sources = [s for s in sources if s.source_type == "med"]
-    
-    # Template responses based on question keywords
-    if "last 90 days" in question_lower or "changed" in question_lower or "recent" in question_lower:
-        answer = _template_changes_response(patient_name, note_sources, lab_sources, med_sources)
-        next_actions = [
+# Template routes in priority order: (question keywords, answer builder, next actions).
+# Answer builders take (patient_name, sources, sources bucketed by type).
+_TEMPLATE_ROUTES = (
+    (
+        ("last 90 days", "changed", "recent"),
+        lambda name, sources, by_type: _template_changes_response(
+            name, by_type["note"], by_type["lab"], by_type["med"]
+        ),
+        (
             "Review medication changes with patient",
             "Confirm lab trends are in expected direction",
             "Schedule follow-up to assess treatment response"
-        ]
-    
-    elif "lisinopril" in question_lower or "dose" in question_lower:
-        answer = _template_medication_response(patient_name, med_sources, lab_sources, note_sources)
-        next_actions = [
+        ),
+    ),
+    (
+        ("lisinopril", "dose"),
+        lambda name, sources, by_type: _template_medication_response(
+            name, by_type["med"], by_type["lab"], by_type["note"]
+        ),
+        (
             "Monitor potassium and kidney function",
             "Assess blood pressure response to dose change",
             "Document rationale in medication history"
-        ]
-    
-    elif "risk" in question_lower or "action" in question_lower:
-        answer = _template_risk_response(patient_name, sources)
-        next_actions = [
+        ),
+    ),
+    (
+        ("risk", "action"),
+        lambda name, sources, by_type: _template_risk_response(name, sources),
+        (
             "Prioritize kidney function monitoring",
             "Ensure diabetes management is optimized",
             "Review cardiovascular risk factors"
-        ]
+        ),
+    ),
+)
+_TEMPLATE_GENERIC_ROUTE = (
+    (),
+    lambda name, sources, by_type: _template_generic_response(name, sources),
+    (
+        "Review relevant clinical context",
+        "Document findings in patient record",
+        "Follow up as clinically indicated"
+    ),
+)
+# Keyword -> route priority, and a single alternation so the question is scanned once
+_TEMPLATE_KEYWORDS = {
+    keyword: priority
+    for priority, (keywords, _, _) in enumerate(_TEMPLATE_ROUTES)
+    for keyword in keywords
+}
+_TEMPLATE_KEYWORD_RE = re.compile("|".join(re.escape(k) for k in _TEMPLATE_KEYWORDS))
+
+
+def _match_template_route(question_lower: str) -> tuple:
+    """Return the highest-priority template route matched by the question."""
+    matched = {_TEMPLATE_KEYWORDS[m.group()] for m in _TEMPLATE_KEYWORD_RE.finditer(question_lower)}
+    return _TEMPLATE_ROUTES[min(matched)] if matched else _TEMPLATE_GENERIC_ROUTE
+
+
+def _generate_template_response(
+    question: str,
+    patient_name: str,
+    sources: list[CopilotSource]
+) -> Tuple[str, list[str], None]:
+    """Generate a template-based response when Azure OpenAI is not available."""
     
-    else:
-        # Generic response
-        answer = _template_generic_response(patient_name, sources)
-        next_actions = [
-            "Review relevant clinical context",
-            "Document findings in patient record",
-            "Follow up as clinically indicated"
-        ]
+    # Template response based on question keywords
+    _, build_answer, next_actions = _match_template_route(question.lower())
+    
+    # Build source summary (bucket sources by type in a single pass)
+    buckets: dict[str, list[CopilotSource]] = {"note": [], "lab": [], "med": []}
+    for source in sources:
+        bucket = buckets.get(source.source_type)
+        if bucket is not None:
+            bucket.append(source)
+    
+    answer = build_answer(patient_name, sources, buckets)
     
-    return answer, next_actions, None
+    return answer, list(next_actions), None
 
 
 def _template_changes_response(
@@ -474,7 +520,7 @@ def _template_risk_response(
     
     parts.append("\n**Based on Available Sources:**")
     for source in sources[:3]:
-        parts.append(f"- [{source.source_type.upper()}] {source.label}")
+        parts.append(f"- [{_source_type_label(source.source_type)}] {source.label}")
     
     return "\n".join(parts)
 
@@ -490,7 +536,7 @@ def _template_generic_response(
     if sources:
         parts.append("**Relevant Information Found:**")
         for source in sources[:5]:
-            parts.append(f"\n[{source.source_type.upper()} - {source.label}]")
+            parts.append(f"\n[{_source_type_label(source.source_type)} - {source.label}]")
             parts.append(source.snippet[:200] + "..." if len(source.snippet) > 200 else source.snippet)
     else:
         parts.append("No relevant information found in the available records.")
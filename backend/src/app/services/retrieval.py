@@ -4,15 +4,165 @@ Patient 360 Backend - Retrieval Service
 Provides context retrieval using vector similarity and keyword search.
 """
 
-import json
+import hashlib
 import logging
-from typing import Tuple
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
 
-from app.db import execute_query
+import numpy as np
+import orjson
+
+from app.db import execute_query, execute_query_records, execute_scalar
 from app.settings import get_settings
 
 logger = logging.getLogger(__name__)
 
+# Query embedding cache (avoids repeat Azure OpenAI round-trips for the same query text)
+EMBEDDING_CACHE_MAX_ENTRIES = 512
+
+# sha256(query) -> float32 embedding
+_embedding_cache: OrderedDict[str, np.ndarray] = OrderedDict()
+_embedding_cache_hits = 0
+_embedding_cache_misses = 0
+
+# Semantic retrieval cache: reuse results of an earlier, near-identical query
+# (cosine similarity of the query embeddings) for the same patient. Disabled
+# unless SEMANTIC_CACHE_ENABLED is set: questions about different labs (e.g.
+# potassium vs sodium) can embed above the threshold.
+SEMANTIC_CACHE_THRESHOLD = 0.92
+SEMANTIC_CACHE_TTL_SECONDS = 300.0
+SEMANTIC_CACHE_MAX_ENTRIES_PER_PATIENT = 32
+SEMANTIC_CACHE_MAX_PATIENTS = 1024
+
+# (patient_id, max_results) -> [(time.monotonic() expiry, unit query vector, results, retrieval method)]
+_semantic_cache: OrderedDict[
+    tuple[str, int], list[tuple[float, np.ndarray, list[dict], str]]
+] = OrderedDict()
+
+
+def cache_info() -> dict:
+    """Return query embedding cache statistics."""
+    return {
+        "hits": _embedding_cache_hits,
+        "misses": _embedding_cache_misses,
+        "size": len(_embedding_cache),
+        "max_size": EMBEDDING_CACHE_MAX_ENTRIES,
+    }
+
+
+async def _get_query_embedding(query: str) -> Optional[np.ndarray]:
+    """
+    Get the embedding for a query as a float32 vector, using the LRU cache.
+    
+    Returns None if no embedding could be generated (e.g. Azure OpenAI is
+    not configured); failures are not cached.
+    """
+    global _embedding_cache_hits, _embedding_cache_misses
+    
+    key = hashlib.sha256(query.encode()).hexdigest()
+    embedding = _embedding_cache.get(key)
+    if embedding is not None:
+        _embedding_cache_hits += 1
+        _embedding_cache.move_to_end(key)
+        return embedding
+    
+    _embedding_cache_misses += 1
+    embedding_text = await execute_scalar("SELECT generate_embedding($1)::text", query)
+    if embedding_text is None:
+        return None
+    
+    # pgvector text output is a JSON array; keep it as packed float32, not boxed floats
+    embedding = np.asarray(orjson.loads(embedding_text), dtype=np.float32)
+    _embedding_cache[key] = embedding
+    while len(_embedding_cache) > EMBEDDING_CACHE_MAX_ENTRIES:
+        _embedding_cache.popitem(last=False)
+    return embedding
+
+
+def _vector_literal(embedding) -> Optional[str]:
+    """Format an embedding (NumPy array or list) as pgvector text, passing None through."""
+    if embedding is None:
+        return None
+    return orjson.dumps(embedding, option=orjson.OPT_SERIALIZE_NUMPY).decode()
+
+
+def _unit_vector(embedding: np.ndarray) -> np.ndarray:
+    """Scale an embedding to unit length."""
+    norm = np.linalg.norm(embedding)
+    return embedding / norm if norm else embedding
+
+
+def _semantic_cache_get(
+    key: tuple[str, int],
+    query_vector: np.ndarray
+) -> Optional[Tuple[list[dict], str]]:
+    """Return cached results for the most similar earlier query, if similar enough."""
+    entries = _semantic_cache.get(key)
+    if not entries:
+        return None
+    
+    now = time.monotonic()
+    entries[:] = [entry for entry in entries if entry[0] > now]
+    if not entries:
+        del _semantic_cache[key]
+        return None
+    
+    # Cosine similarity against every cached query in one matrix-vector product
+    similarities = np.stack([entry[1] for entry in entries]) @ query_vector
+    best = int(np.argmax(similarities))
+    if similarities[best] < SEMANTIC_CACHE_THRESHOLD:
+        return None
+    
+    _semantic_cache.move_to_end(key)
+    _, _, results, retrieval_method = entries[best]
+    return results, retrieval_method
+
+
+def _semantic_cache_put(
+    key: tuple[str, int],
+    query_vector: np.ndarray,
+    results: list[dict],
+    retrieval_method: str
+) -> None:
+    """Cache retrieval results under the query's embedding."""
+    entries = _semantic_cache.setdefault(key, [])
+    entries.append((time.monotonic() + SEMANTIC_CACHE_TTL_SECONDS, query_vector, results, retrieval_method))
+    del entries[:-SEMANTIC_CACHE_MAX_ENTRIES_PER_PATIENT]
+    
+    _semantic_cache.move_to_end(key)
+    while len(_semantic_cache) > SEMANTIC_CACHE_MAX_PATIENTS:
+        _semantic_cache.popitem(last=False)
+
+
+def invalidate_patient_context(patient_id: str) -> None:
+    """Drop a patient's cached retrieval results after a write that affects them."""
+    for key in [key for key in _semantic_cache if key[0] == patient_id]:
+        del _semantic_cache[key]
+
+
+def _process_context_results(results: list[dict]) -> Tuple[list[dict], str]:
+    """Normalize retrieve_context rows and determine the retrieval method used."""
+    # Determine retrieval method used: every row carries the same
+    # has_vector_results flag, computed in SQL over the whole result set
+    has_vector_results = bool(results) and bool(results[0]["has_vector_results"])
+    
+    retrieval_method = "vector" if has_vector_results else "keyword"
+    
+    # Process results (metadata JSONB is already decoded by the connection's codec)
+    processed_results = []
+    for r in results:
+        processed_results.append({
+            "source_type": r.get("source_type"),
+            "source_id": r.get("source_id"),
+            "label": r.get("label"),
+            "snippet": r.get("snippet"),
+            "score": float(r.get("score", 0)),
+            "metadata": r.get("metadata", {})
+        })
+    
+    return processed_results, retrieval_method
+
 
 async def retrieve_context(
     patient_id: str,
@@ -22,71 +172,153 @@ async def retrieve_context(
     """
     Retrieve relevant context for a patient query.
     
-    Uses the retrieve_context SQL function which handles:
+    Uses the retrieve_context_with_vec SQL function which handles:
     - Vector similarity search over notes (if embeddings available)
     - Keyword search fallback
     - Merged results from notes, labs, and medications
     
+    The query embedding comes from the embedding LRU. With
+    SEMANTIC_CACHE_ENABLED, if an earlier query for the same patient had a
+    near-identical embedding, its results are returned from the semantic
+    cache without running retrieval again.
+    
+    An empty (or whitespace-only) query skips search entirely and returns
+    the patient's most recent records.
+    
     Returns:
         Tuple of (results list, retrieval method used)
     """
-    settings = get_settings()
-    
     try:
-        # Call the database retrieval function
-        results = await execute_query(
-            """
-            SELECT 
-                source_type,
-                source_id,
-                label,
-                snippet,
-                score,
-                metadata
-            FROM retrieve_context($1, $2, $3)
-            """,
-            patient_id, query, max_results
-        )
+        if not query or not query.strip():
+            return await _recent_context(patient_id, max_results), "recent"
+        
+        query_embedding = await _get_query_embedding(query)
         
-        # Determine retrieval method used
-        # Check if any notes came from vector search (higher scores typically)
-        has_vector_results = False
-        for r in results:
-            if r.get("source_type") == "note" and r.get("score", 0) > 0.5:
-                has_vector_results = True
-                break
+        cache_key = (patient_id, max_results)
+        query_vector = None
+        if query_embedding is not None and get_settings().semantic_cache_enabled:
+            query_vector = _unit_vector(query_embedding)
+            cached = _semantic_cache_get(cache_key, query_vector)
+            if cached is not None:
+                logger.info("Semantic cache hit for patient %s", patient_id)
+                return cached
         
-        retrieval_method = "vector" if has_vector_results else "keyword"
+        processed_results, retrieval_method = await _fetch_context(
+            patient_id, query, _vector_literal(query_embedding), max_results
+        )
         
-        # Process results
-        processed_results = []
-        for r in results:
-            metadata = r.get("metadata", {})
-            if isinstance(metadata, str):
-                metadata = json.loads(metadata)
-            
-            processed_results.append({
-                "source_type": r.get("source_type"),
-                "source_id": r.get("source_id"),
-                "label": r.get("label"),
-                "snippet": r.get("snippet"),
-                "score": float(r.get("score", 0)),
-                "metadata": metadata
-            })
+        if query_vector is not None:
+            _semantic_cache_put(cache_key, query_vector, processed_results, retrieval_method)
         
         logger.info(
-            f"Retrieved {len(processed_results)} results for patient {patient_id} "
-            f"using {retrieval_method} search"
+            "Retrieved %d results for patient %s using %s search",
+            len(processed_results), patient_id, retrieval_method
         )
         
         return processed_results, retrieval_method
         
     except Exception as e:
-        logger.error(f"Error retrieving context: {str(e)}")
+        logger.error("Error retrieving context: %s", e)
         # Return empty results on error
         return [], "error"
 
 
+async def _recent_context(patient_id: str, max_results: int) -> list[dict]:
+    """Get the patient's most recent notes, labs, and medications (no search)."""
+    results = await execute_query(
+        """
+        SELECT source_type, source_id, label, snippet, score, metadata
+        FROM (
+            (SELECT 
+                'note'::TEXT AS source_type,
+                note_id AS source_id,
+                'Note ' || to_char(created_at, 'YYYY-MM-DD') AS label,
+                LEFT(redacted_text, 300) AS snippet,
+                1.0::DOUBLE PRECISION AS score,
+                jsonb_build_object(
+                    'encounter_id', encounter_id,
+                    'created_at', created_at
+                ) AS metadata,
+                created_at AS recorded_at
+            FROM notes_phi
+            WHERE patient_id = $1
+            ORDER BY created_at DESC LIMIT $2)
+            UNION ALL
+            (SELECT 
+                'lab'::TEXT,
+                obs_id,
+                display || ' (' || to_char(observed_at, 'YYYY-MM-DD') || ')',
+                display || ': ' || COALESCE(value_text, value_num::text, 'N/A') || ' ' || COALESCE(unit, ''),
+                1.0::DOUBLE PRECISION,
+                jsonb_build_object(
+                    'code', code,
+                    'value_num', value_num,
+                    'unit', unit,
+                    'observed_at', observed_at,
+                    'encounter_id', encounter_id
+                ),
+                observed_at
+            FROM observations
+            WHERE patient_id = $1
+            ORDER BY observed_at DESC LIMIT $2)
+            UNION ALL
+            (SELECT 
+                'med'::TEXT,
+                med_id,
+                name || ' ' || COALESCE(dose, ''),
+                name || ' ' || COALESCE(dose, '') || ' ' || COALESCE(frequency, '') ||
+                '. Reason: ' || COALESCE(reason, 'Not specified') || '. Status: ' || COALESCE(status, 'unknown'),
+                1.0::DOUBLE PRECISION,
+                jsonb_build_object(
+                    'dose', dose,
+                    'frequency', frequency,
+                    'status', status,
+                    'start_date', start_date,
+                    'end_date', end_date,
+                    'reason', reason
+                ),
+                start_date::TIMESTAMPTZ
+            FROM medications
+            WHERE patient_id = $1
+            ORDER BY start_date DESC LIMIT $2)
+        ) recent
+        ORDER BY recorded_at DESC NULLS LAST
+        LIMIT $2
+        """,
+        patient_id, max_results
+    )
+    
+    logger.info("Retrieved %d recent records for patient %s", len(results), patient_id)
+    
+    return results
+
+
+async def _fetch_context(
+    patient_id: str,
+    query: str,
+    query_embedding: Optional[str],
+    max_results: int
+) -> Tuple[list[dict], str]:
+    """Run retrieve_context_with_vec with a pgvector text embedding (None = keyword search)."""
+    results = await execute_query(
+        """
+        SELECT 
+            source_type,
+            source_id,
+            label,
+            snippet,
+            score,
+            metadata,
+            -- Any notes from vector search (higher scores typically)
+            bool_or(source_type = 'note' AND score > 0.5) OVER () AS has_vector_results
+        FROM retrieve_context_with_vec($1, $2, $3::text::vector, $4)
+        """,
+        patient_id, query, query_embedding, max_results
+    )
+    
+    return _process_context_results(results)
+
+
 async def retrieve_notes_only(
     patient_id: str,
     query: str,
@@ -98,97 +330,127 @@ async def retrieve_notes_only(
     Simpler retrieval for note-focused queries.
     """
     try:
-        # Try vector search first
-        results = await execute_query(
+        query_embedding = await _get_query_embedding(query)
+        
+        # Vector search over embedded notes, plus keyword search over notes
+        # without embeddings (or all notes, if the query has no embedding).
+        # Each branch filters notes_phi directly, so the keyword branch can
+        # use the idx_notes_phi_text_trgm index for its ILIKE.
+        results = await execute_query_records(
             """
             SELECT 
                 note_id,
-                redacted_text,
-                created_at,
-                CASE 
-                    WHEN embedding IS NOT NULL THEN 
-                        1 - (embedding <=> (SELECT generate_embedding($1)))
-                    ELSE 0.5
-                END as similarity
-            FROM notes_phi
-            WHERE patient_id = $2
-            AND (
-                embedding IS NOT NULL 
-                OR redacted_text ILIKE $3
-            )
+                'Note ' || COALESCE(to_char(created_at, 'YYYY-MM-DD'), 'Unknown') as label,
+                LEFT(redacted_text, 300) as snippet,
+                similarity
+            FROM (
+                SELECT note_id, created_at, redacted_text,
+                       1 - (embedding <=> $1::text::vector) as similarity
+                FROM notes_phi
+                WHERE patient_id = $2 AND embedding IS NOT NULL AND $1::text IS NOT NULL
+                UNION ALL
+                SELECT note_id, created_at, redacted_text, 0.5
+                FROM notes_phi
+                WHERE patient_id = $2 AND ($1::text IS NULL OR embedding IS NULL)
+                  AND redacted_text ILIKE $3
+            ) matches
             ORDER BY similarity DESC
             LIMIT $4
             """,
-            query, patient_id, f"%{query}%", max_results
+            _vector_literal(query_embedding), patient_id, f"%{query}%", max_results
         )
         
         return [
             {
                 "source_type": "note",
-                "source_id": r.get("note_id"),
-                "label": f"Note {r.get('created_at', '').strftime('%Y-%m-%d') if r.get('created_at') else 'Unknown'}",
-                "snippet": r.get("redacted_text", "")[:300],
-                "score": float(r.get("similarity", 0))
+                "source_id": note_id,
+                "label": label,
+                "snippet": snippet,
+                "score": float(similarity)
             }
-            for r in results
+            for note_id, label, snippet, similarity in results
         ]
         
     except Exception as e:
-        logger.error(f"Error retrieving notes: {str(e)}")
+        logger.error("Error retrieving notes: %s", e)
         return []
 
 
+# Label and snippet are formatted by Postgres; Python only wraps the rows.
+# One statement for both cases: a NULL $2 disables the code filter.
+_LABS_QUERY = """
+    SELECT 
+        obs_id,
+        display || ' (' || COALESCE(to_char(observed_at, 'YYYY-MM-DD'), 'Unknown') || ')' as label,
+        COALESCE(value_text, value_num::text, 'N/A') || ' ' || COALESCE(unit, '') as snippet,
+        code,
+        COALESCE(value_text, value_num::text) as value,
+        unit
+    FROM observations
+    WHERE patient_id = $1 AND ($2::text[] IS NULL OR code = ANY($2::text[]))
+    ORDER BY observed_at DESC LIMIT $3
+"""
+
+# Per-code variant: the latest $3 results for each requested code, grouped by
+# code (Postgres does the bucketing, so callers need no client-side groupby)
+_LABS_BY_CODE_QUERY = """
+    SELECT obs_id, label, snippet, code, value, unit
+    FROM (
+        SELECT 
+            obs_id,
+            display || ' (' || COALESCE(to_char(observed_at, 'YYYY-MM-DD'), 'Unknown') || ')' as label,
+            COALESCE(value_text, value_num::text, 'N/A') || ' ' || COALESCE(unit, '') as snippet,
+            code,
+            COALESCE(value_text, value_num::text) as value,
+            unit,
+            observed_at,
+            ROW_NUMBER() OVER (PARTITION BY code ORDER BY observed_at DESC) as rn
+        FROM observations
+        WHERE patient_id = $1 AND code = ANY($2::text[])
+    ) t
+    WHERE rn <= $3
+    ORDER BY code, observed_at DESC
+"""
+
+
+def _lab_source(row) -> dict:
+    """Wrap a _LABS_QUERY row as a lab source dict."""
+    obs_id, label, snippet, code, value, unit = row
+    return {
+        "source_type": "lab",
+        "source_id": obs_id,
+        "label": label,
+        "snippet": snippet,
+        "score": 1.0,
+        "metadata": {
+            "code": code,
+            "value": value,
+            "unit": unit
+        }
+    }
+
+
 async def retrieve_labs(
     patient_id: str,
     codes: list[str] = None,
-    limit: int = 10
+    limit: int = 10,
+    per_code_limit: Optional[int] = None
 ) -> list[dict]:
-    """Retrieve lab observations for a patient."""
+    """
+    Retrieve lab observations for a patient.
     
-    if codes:
-        query = """
-            SELECT 
-                obs_id,
-                code,
-                display,
-                COALESCE(value_text, value_num::text) as value,
-                unit,
-                observed_at
-            FROM observations
-            WHERE patient_id = $1 AND code = ANY($2)
-            ORDER BY observed_at DESC LIMIT $3
-        """
-        results = await execute_query(query, patient_id, codes, limit)
+    Returns the latest `limit` observations overall, optionally restricted
+    to `codes`. If both `codes` and `per_code_limit` are given, returns up to
+    `per_code_limit` of the latest observations for each code instead,
+    grouped by code.
+    """
+    
+    if codes and per_code_limit is not None:
+        results = await execute_query_records(_LABS_BY_CODE_QUERY, patient_id, codes, per_code_limit)
     else:
-        query = """
-            SELECT 
-                obs_id,
-                code,
-                display,
-                COALESCE(value_text, value_num::text) as value,
-                unit,
-                observed_at
-            FROM observations
-            WHERE patient_id = $1
-            ORDER BY observed_at DESC LIMIT $2
-        """
-        results = await execute_query(query, patient_id, limit)
+        results = await execute_query_records(_LABS_QUERY, patient_id, codes or None, limit)
     
-    return [
-        {
-            "source_type": "lab",
-            "source_id": r.get("obs_id"),
-            "label": f"{r.get('display')} ({r.get('observed_at', '').strftime('%Y-%m-%d') if r.get('observed_at') else 'Unknown'})",
-            "snippet": f"{r.get('value', 'N/A')} {r.get('unit', '')}",
-            "score": 1.0,
-            "metadata": {
-                "code": r.get("code"),
-                "value": r.get("value"),
-                "unit": r.get("unit")
-            }
-        }
-        for r in results
-    ]
+    return [_lab_source(row) for row in results]
 
 
 async def retrieve_medications(
@@ -198,52 +460,39 @@ async def retrieve_medications(
 ) -> list[dict]:
     """Retrieve medications for a patient."""
     
-    if status:
-        query = """
-            SELECT 
-                med_id,
-                name,
-                dose,
-                frequency,
-                status,
-                start_date,
-                end_date,
-                reason
-            FROM medications
-            WHERE patient_id = $1 AND status = $2
-            ORDER BY start_date DESC LIMIT $3
-        """
-        results = await execute_query(query, patient_id, status, limit)
-    else:
-        query = """
-            SELECT 
-                med_id,
-                name,
-                dose,
-                frequency,
-                status,
-                start_date,
-                end_date,
-                reason
-            FROM medications
-            WHERE patient_id = $1
-            ORDER BY start_date DESC LIMIT $2
+    # Label and snippet are formatted by Postgres; Python only wraps the rows.
+    # One statement for both cases: a NULL $2 disables the status filter.
+    results = await execute_query_records(
         """
-        results = await execute_query(query, patient_id, limit)
+        SELECT 
+            med_id,
+            name || ' ' || COALESCE(dose, '') as label,
+            name || ' ' || COALESCE(dose, '') || ' ' || COALESCE(frequency, '')
+                || ' - Status: ' || COALESCE(status, 'unknown') as snippet,
+            dose,
+            frequency,
+            status,
+            reason
+        FROM medications
+        WHERE patient_id = $1 AND ($2::text IS NULL OR status = $2::text)
+        ORDER BY start_date DESC LIMIT $3
+        """,
+        patient_id, status or None, limit
+    )
     
     return [
         {
             "source_type": "med",
-            "source_id": r.get("med_id"),
-            "label": f"{r.get('name')} {r.get('dose', '')}",
-            "snippet": f"{r.get('name')} {r.get('dose', '')} {r.get('frequency', '')} - Status: {r.get('status', 'unknown')}",
+            "source_id": med_id,
+            "label": label,
+            "snippet": snippet,
             "score": 1.0,
             "metadata": {
-                "dose": r.get("dose"),
-                "frequency": r.get("frequency"),
-                "status": r.get("status"),
-                "reason": r.get("reason")
+                "dose": dose,
+                "frequency": frequency,
+                "status": med_status,
+                "reason": reason
             }
         }
-        for r in results
+        for med_id, label, snippet, dose, frequency, med_status, reason in results
     ]
@@ -4,12 +4,18 @@ Patient 360 Backend - Settings Module
 Loads configuration from environment variables with validation.
 """
 
-from functools import lru_cache
+import os
+from functools import cached_property, lru_cache
 from pathlib import Path
 from typing import Optional
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
+# In production, configuration comes only from the environment set by the
+# orchestrator, so skip looking for .env files
+ENV_FILES = None if os.getenv("ENV") == "production" else [".env", "../.env"]
+
+
 class Settings(BaseSettings):
     """Application settings loaded from environment variables."""
     
@@ -17,6 +23,10 @@ class Settings(BaseSettings):
     database_url: str
     db_pool_min_size: int = 2
     db_pool_max_size: int = 10
+    db_statement_cache_size: int = 1024  # Prepared statements cached per connection
+    db_pool_prewarm: bool = False  # Open db_pool_max_size connections at startup
+    db_connect_timeout: float = 5.0  # Seconds to wait for a new connection
+    db_command_timeout: float = 60.0  # Seconds before a statement is cancelled
     
     # Azure AI Language (for PHI redaction)
     azure_ai_endpoint: str
@@ -28,9 +38,13 @@ class Settings(BaseSettings):
     azure_openai_embedding_deployment: str = "text-embedding-ada-002"
     azure_openai_chat_deployment: str = "gpt-5.2"
     # Note: api_version not needed for /v1 Responses API
+    # Reuse retrieval results for near-identical query embeddings (cosine >= 0.92).
+    # Off by default: distinct clinical questions can embed that closely.
+    semantic_cache_enabled: bool = False
     
     # Demo settings
     demo_allow_raw: bool = False
+    demo_fake_streaming: bool = False  # Pace template answers like a live LLM stream
     
     # CORS
     cors_origins: str = "http://localhost:3000"
@@ -39,22 +53,23 @@ class Settings(BaseSettings):
     app_name: str = "Patient 360 API"
     debug: bool = False
     
-    @property
+    @cached_property
     def cors_origins_list(self) -> list[str]:
         """Parse CORS origins into a list."""
         return [origin.strip() for origin in self.cors_origins.split(",")]
     
-    @property
+    @cached_property
     def has_azure_openai(self) -> bool:
         """Check if Azure OpenAI is configured (key or Entra ID)."""
         return bool(self.azure_openai_endpoint)
     
     # Look for .env in parent directory (backend/) when running from src/
     model_config = SettingsConfigDict(
-        env_file=[".env", "../.env"],
+        env_file=ENV_FILES,
         env_file_encoding="utf-8",
         case_sensitive=False,
-        extra="ignore"
+        extra="ignore",
+        frozen=True  # Shared process-wide via get_settings(); never mutated
     )
 
 
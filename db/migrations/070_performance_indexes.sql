@@ -0,0 +1,24 @@
+-- ============================================================================
+-- Migration 070: Performance Indexes
+-- ============================================================================
+-- Indexes supporting the backend's hot read paths.
+-- ============================================================================
+
+-- ----------------------------------------------------------------------------
+-- Note detail lookup (GET /patients/{id}/notes/{note_id})
+-- ----------------------------------------------------------------------------
+-- Covers the (patient_id, note_id) filter and the small metadata columns so
+-- the lookup can be answered from the index. redacted_text and phi_entities
+-- are left out: they can exceed the btree index row size limit.
+CREATE INDEX IF NOT EXISTS idx_notes_phi_patient_note ON notes_phi(patient_id, note_id)
+INCLUDE (encounter_id, created_at);
+
+-- ----------------------------------------------------------------------------
+-- Note keyword search (retrieve_notes_only ILIKE '%query%' fallback)
+-- ----------------------------------------------------------------------------
+-- A leading-wildcard ILIKE cannot use a btree or the full-text index; a
+-- trigram GIN index lets it use an index scan instead of reading every note.
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE INDEX IF NOT EXISTS idx_notes_phi_text_trgm ON notes_phi
+USING gin (redacted_text gin_trgm_ops);
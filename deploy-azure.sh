@@ -103,6 +103,18 @@ az containerapp env create \
     --resource-group $RESOURCE_GROUP \
     --location $LOCATION
 
+# -----------------------------------------------------------------------------
+# Step 5b: Apply Database Migrations Required by the Backend
+# -----------------------------------------------------------------------------
+echo "🗄️ Applying database migrations..."
+for migration in db/migrations/070_performance_indexes.sql db/migrations/080_retrieve_context_with_vec.sql; do
+    PGPASSWORD="$DB_PASSWORD" psql \
+        "host=$DB_HOST dbname=$DB_NAME user=$DB_USER sslmode=require" \
+        -v ON_ERROR_STOP=1 -f "$migration"
+done
+
+echo "✅ Database migrations applied"
+
 # -----------------------------------------------------------------------------
 # Step 6: Deploy Backend to Container Apps
 # -----------------------------------------------------------------------------
@@ -134,7 +146,8 @@ az containerapp create \
         AZURE_OPENAI_CHAT_DEPLOYMENT="$AZURE_OPENAI_CHAT_DEPLOYMENT" \
         AZURE_OPENAI_EMBEDDING_DEPLOYMENT="$AZURE_OPENAI_EMBEDDING_DEPLOYMENT" \
         CORS_ORIGINS="https://${FRONTEND_APP_NAME}.azurewebsites.net,http://localhost:3000" \
-        DEMO_ALLOW_RAW="false"
+        DEMO_ALLOW_RAW="false" \
+        ENV="production"
 
 # Get backend URL
 BACKEND_URL=$(az containerapp show \